@@ -2,17 +2,21 @@
 
 import argparse
 import base64
-import colorsys
+import collections
 import dataclasses
 import datetime
+import functools
 import gzip
-import html.parser
+import http.client
 import http.server
+import io
 import json
 import logging
+import mimetypes
 import os
 import re
 import shutil
+import ssl
 import subprocess
 import sys
 import threading
@@ -20,7 +24,8 @@ import traceback
 import time
 import urllib.error, urllib.parse, urllib.request
 import webbrowser
-from html import escape, unescape
+import zlib
+from html import unescape
 from typing import *
 
 # base
@@ -50,7 +55,8 @@ emoji = { "love": "💙", "search": "🔍" }
 def fcache(expiry=600, namef=lambda:"None"):
     def decor(f):
         def f2(*args, **kwargs):
-            return withFileCache(namef(*args, **kwargs), lambda: f(*args, **kwargs), expiry)
+            name = namef(*args, **kwargs)
+            return withMemoryCache(name, lambda: withFileCache(name, lambda: f(*args, **kwargs), expiry), expiry)
         return f2
     return decor
 
@@ -79,19 +85,21 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
 
     def send(self, status, mime, headers, body):
 
-        gz = "gzip" in (self.headers["Accept-Encoding"] or "")
-
         if type(body) is str:
             body = body.encode()
+
+        # small responses (e.g. error pages) are not worth compressing
+        gz = "gzip" in (self.headers["Accept-Encoding"] or "") and mime.startswith("text/") and len(body) >= 1024
         if gz:
-            body = gzip.compress(body)
+            body = gzip.compress(body, compresslevel=1) # level 1: much faster, compresses html almost as well
 
         self.send_response(status)
 
         for k, v in headers:
             self.send_header(k, v)
         self.send_header("Content-type", mime)
-        if gz: self.send_header("Content-Encoding", "gzip")
+        if gz:
+            self.send_header("Content-Encoding", "gzip")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
 
@@ -103,9 +111,9 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
 
     def do_GET(self):
 
-        parsed = urllib.parse.urlparse(self.path)
-        paths  = [x for x in parsed.path.split("/") if x]
-        param  = { k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items() }
+        path, _, query = self.path.partition("?")
+        paths  = [x for x in path.split("/") if x]
+        param  = parseQuery(query)
 
         try:
             status, mime, headers, body = self.action(paths, param)
@@ -118,10 +126,10 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
 
     def action(self, paths, param):
         if len(paths) == 0:
-            return self.action(["pixiv", "ranking"], param)
+            paths = ["pixiv", "ranking"]
         elif len(paths) == 1:
-            return self.action(["pixiv"] + paths, param)
-        elif len(paths) == 2:
+            paths = ["pixiv"] + paths
+        if len(paths) == 2:
             site, cmd = paths[0], paths[1]
             # Select backend for site
             try:
@@ -135,6 +143,9 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
                 return 400, "text/plain", [], f"No such cmd on site: {cmd} on {site}"
             # Get data
             data = makeData(**param).data() # e.g. BackendPixiv.Novel(**param).data() : viewNovelData
+            # Raw data (e.g. images) is sent as is
+            if type(data) is viewRawData:
+                return 200, data.mime, data.headers, data.body
             # Select view function
             makeView = VIEW_TABLE[type(data)]
             # Render view
@@ -162,16 +173,11 @@ class BackendPixiv:
             self._query         = q
             self._bookmarkCount = int(bookmarkCount)
             self._page          = max(1, int(page))
-            self._npages        = min(1, max(3, int(npages)))
+            self._npages        = max(1, min(3, int(npages)))
             self._mode          = mode
 
         def data(self):
 
-            dataList = [
-                x for x in self._getDataList()
-                if int(x["bookmarkCount"]) >= self._bookmarkCount
-            ]
-
             items = [viewSearchDataItem(
                 title  = x["title"],
                 id     = x["id"],
@@ -181,7 +187,7 @@ class BackendPixiv:
                 score  = x["bookmarkCount"],
                 length = x["textCount"],
                 user   = (x["userId"], x["userName"])
-            ) for x in dataList]
+            ) for x in self._getDataList() if int(x["bookmarkCount"]) >= self._bookmarkCount]
 
             attr = lambda a, d: getattr(self, a) if hasattr(self, a) else d
 
@@ -276,12 +282,18 @@ class BackendPixiv:
             "male_r18":        "男子に人気 R-18",
             "female_r18":      "女子に人気 R-18",
         }
+        _modesNonR18 = tuple((kind, name) for kind, name in _modeNames.items() if "r18" not in kind)
+        _modesR18    = tuple((kind, name.replace(" R-18", "")) for kind, name in _modeNames.items() if "r18" in kind)
+
+        _dateRegex = re.compile(r"\d\d\d\d-\d\d-\d\d")
+
+        _deleteNonDigits = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isdigit())) # for ascii chars
 
         def __init__(self, kind="daily", date="", mode="detailed"):
             self._kind = kind
 
             # set self._date to a date object (at most yesterday)
-            if re.match(r"\d\d\d\d-\d\d-\d\d", date):
+            if self._dateRegex.match(date):
                 d = datetime.date.fromisoformat(date)
                 y = yesterday()
                 self._date = d if d <= y else y
@@ -305,16 +317,19 @@ class BackendPixiv:
             data = []
 
             p = StringParser(html) # faster than html parser
-            toInt = lambda s: int(re.sub(r"\D+", "", s))
+            def toInt(s): # e.g. "1,234" => 1234
+                digits = s.translate(self._deleteNonDigits)
+                return int(digits if digits.isascii() else re.sub(r"\D+", "", s))
+            xRestrict = "r18" in self._kind
             for _ in range(50):
                 d = {}
                 # one novel for each ._novel-item
                 if p.seek("_novel-item") == -1:
                     break
-                d["xRestrict"]     = "r18" in self._kind
+                d["xRestrict"]     = xRestrict
                 # attrs from img.cover
-                d["title"]         = re.sub(r"/.*", "", p.extract('alt="', '"'))
-                d["tags"]          = p.extract('data-tags="', '"').split()
+                d["title"]         = unescape(p.extract('alt="', '"').partition("/")[0])
+                d["tags"]          = [unescape(x) for x in p.extract('data-tags="', '"').split()]
                 d["id"]            = p.extract('data-id="', '"')
                 # innerHTML from div.chars
                 d["textCount"]     = toInt(p.extract('<div class="chars">', '文字</div>'))
@@ -324,7 +339,7 @@ class BackendPixiv:
                 d["description"]   = unescape(p.extract('<p class="novel-caption">', '</p>', default="").strip())
                 # attrs from a.user
                 d["userId"]        = p.extract('data-user_id="', '"')
-                d["userName"]      = p.extract('data-user_name="', '"')
+                d["userName"]      = unescape(p.extract('data-user_name="', '"'))
                 # add entry to list
                 data.append(d)
 
@@ -336,10 +351,11 @@ class BackendPixiv:
         def _html_header(self, compact):
             # links for other rankings
             hrefBase = mkurl("ranking", mode="compact" if compact else "detailed", date=self._date)
-            modeLinks1 = "\n".join([f"""<a href="{hrefBase}&kind={kind}"{ ' class="ranking-selected"' if kind == self._kind else ""}>{self._modeNames[kind]}</a>""" for kind in self._modeNames.keys() if not "r18" in kind])
+            modeLink = lambda kind, name: f"""<a href="{hrefBase}&kind={kind}"{' class="ranking-selected"' if kind == self._kind else ""}>{name}</a>"""
+            modeLinks1 = "\n".join([modeLink(kind, name) for kind, name in self._modesNonR18])
             if Resources.Pixiv.hasCookie():
                 modeLinks2 = "<span>R-18:</span>"
-                modeLinks2 += "\n".join([f"""<a href="{hrefBase}&kind={kind}"{ ' class="ranking-selected"' if kind == self._kind else ""}>{self._modeNames[kind].replace(" R-18", "")}</a>""" for kind in self._modeNames.keys() if "r18" in kind])
+                modeLinks2 += "\n".join([modeLink(kind, name) for kind, name in self._modesR18])
             else:
                 modeLinks2 = "R-18 ランキングを見るには cookies.txt が必要です。"
             modeLinksCSS = """
@@ -366,7 +382,7 @@ class BackendPixiv:
                     <input type="date" id="date" name="date" value="{self._date}" max="{yesterday()}">
                     <input type="submit" value="{emoji['search']}">
                     <input type="hidden" name="kind" value="{self._kind}">
-                    <input type="hidden" name="mode" value="{1 if compact else ''}">
+                    <input type="hidden" name="mode" value="{'compact' if compact else 'detailed'}">
                 </form>
             """
 
@@ -374,57 +390,65 @@ class BackendPixiv:
 
     class Novel:
 
+        # markups in novel content; the outermost group names are used to select the replacement
+        _markupRegex = re.compile("|".join([
+            r"(?P<br>$)",
+            r"(?P<newpage>\[newpage\])",
+            r"(?P<chapter>\[chapter:(?P<chapterTitle>.*?)\])",
+            r"(?P<ruby>\[\[rb:(?P<rubyBase>.*?)(?:>|&gt;)(?P<rubyText>.*?)\]\])",
+            r"(?P<image>\[(?P<imgType>pixivimage|uploadedimage):(?P<imgId>.*?)\])",
+        ]), re.MULTILINE)
+
         def __init__(self, id):
             self._novelID = id
 
         def data(self):
-            html = Resources.Pixiv.showPhp(self._novelID)
-            jso  = self._extractData(html)
+            jso = self._getData()
 
             o_content = jso["content"]
-            for (regex, replace) in [
-                    (r"$", "<br>"),
-                    (r"\[newpage\]", "<hr>\n"),
-                    (r"\[chapter:(.*?)\]", "<h2>\\1</h2>\n"),
-                    (r"\[\[rb:(.*?)(>|&gt;)(.*?)\]\]", "<ruby>\\1<rt>\\3</rt></ruby>"),
-                    ]:
-                o_content = re.sub(regex, replace, o_content, flags=re.MULTILINE)
 
             # threshold on total embedded image size
             # if total image size exceeds MAX_TOTAL_IMAGE_SIZE, return only link next time
             MAX_TOTAL_IMAGE_SIZE  = 0 if CONFIG["noimage"] else (5 * 10**6) # 5 MBytes
             currentTotalImageSize = 0 # 0 Byte
 
-            # pixivimage
-            def getPixivImg(imgId):
-                assert imgId.isdigit()
-                jso = Resources.Pixiv.artworkPagesJson(imgId)
-                url = jso["body"][0]["urls"]["original"]
-                return url, (currentTotalImageSize < MAX_TOTAL_IMAGE_SIZE) and Resources.Pixiv.artworkImage(url)
-
-            # uploadedimage
-            def getUploadedImg(imgId):
-                assert imgId.isdigit()
-                url = jso["textEmbeddedImages"][imgId]["urls"]["original"]
-                return url, (currentTotalImageSize < MAX_TOTAL_IMAGE_SIZE) and Resources.Pixiv.uploadedImage(url)
-
             # create image tag
+            # images are embedded only when novels are saved (so that saved files work offline),
+            # otherwise they are loaded from /pixiv/image, which can be cached by browsers
             def getImgTag(imgType:"Literal['uploadedimage', 'pixivimage']", imgId):
                 nonlocal currentTotalImageSize
-                url, img = (getPixivImg if imgType == "pixivimage" else getUploadedImg)(imgId)
+                if not CONFIG["savedir"] and not CONFIG["noimage"]:
+                    src = mkurl("pixiv", "image", type=imgType, id=imgId, novel=jso["id"])
+                    return f"""<figure><a href="{src}"><img src="{src}" alt="[{imgType}:{imgId}]" style="width: 100%" loading="lazy"></a></figure>"""
+                url = self._imageURL(jso, imgType, imgId)
+                img = (currentTotalImageSize < MAX_TOTAL_IMAGE_SIZE) and self._image(imgType, url) # stop downloading once over the limit
                 if not img:
                     return f"""<figure><a href="{url}">[{imgType}:{imgId}]</a></figure>"""
                 currentTotalImageSize += len(img)
                 imgB64 = base64.b64encode(img).decode("utf-8")
                 return f"""<figure><a href="{url}"><img src=\"data:image/png;base64,{imgB64}\" alt=\"[{imgType}:{imgId}]\" style=\"width: 100%\"></a></figure>"""
 
-            # replace image links
-            o_content = re.sub(r"\[(pixivimage|uploadedimage):(.*?)\]", lambda m: getImgTag(m.group(1), m.group(2)), o_content)
+            # replace markups (line ends, [newpage] etc.) in a single pass
+            # image links are replaced with "\0" for now (NUL is not valid in html, so removed beforehand),
+            # so that colorHTML (which caches its results) does not get large inline images
+            images = [] # (imgType, imgId) for each "\0"
+            def replaceMarkup(m):
+                if   m.lastgroup == "br":      return "<br>"
+                elif m.lastgroup == "newpage": return "<hr>\n"
+                elif m.lastgroup == "chapter": return f"<h2>{m['chapterTitle']}</h2>\n"
+                elif m.lastgroup == "ruby":    return f"<ruby>{m['rubyBase']}<rt>{m['rubyText']}</rt></ruby>"
+                else:                          images.append((m["imgType"], m["imgId"])); return "\0"
+            o_content = self._markupRegex.sub(replaceMarkup, o_content.replace("\0", ""))
 
             # colorize character names
             if not CONFIG["nocolor"]:
                 o_content = CharaColor.colorHTML(o_content)
 
+            # replace image links (in document order, as getImgTag stops downloading at MAX_TOTAL_IMAGE_SIZE)
+            if images:
+                parts = o_content.split("\0")
+                o_content = parts[0] + "".join(getImgTag(*img) + part for img, part in zip(images, parts[1:]))
+
             tags = [x["tag"] for x in jso["tags"]["tags"]]
 
             # embed json
@@ -453,15 +477,51 @@ class BackendPixiv:
 
             return data
 
+        def _getData(self):
+            return self._extractData(Resources.Pixiv.showPhp(self._novelID))
+
+        @staticmethod
+        def _imageURL(jso, imgType, imgId): # url of [pixivimage:imgId] or [uploadedimage:imgId] in novel jso
+            assert imgId.isdigit()
+            if imgType == "pixivimage":
+                return Resources.Pixiv.artworkPagesJson(imgId)["body"][0]["urls"]["original"]
+            else:
+                return jso["textEmbeddedImages"][imgId]["urls"]["original"]
+
+        @staticmethod
+        def _image(imgType, url):
+            return (Resources.Pixiv.artworkImage if imgType == "pixivimage" else Resources.Pixiv.uploadedImage)(url)
+
         def _extractData(self, html): # parse show.php and get json inside meta[name=preload-data]
             # Extract json string
             # querySelector("meta[name=meta-preload-data]").content
-            s = sfind(html, ["meta-preload-data\" content='", "'"])
-            s = unescape(s)
+            # (str.find stops at the meta tag near the top of <head>; the rest of the page is not scanned)
+            marker = "meta-preload-data\" content='"
+            if marker not in html:
+                raise Exception("BackendPixiv.Novel: meta-preload-data not found in show.php")
+            s = unescape(sfind(html, [marker, "'"]))
 
-            # Extract part of json
+            # Extract part of json (novel data keyed by novel id)
             json1 = json.loads(s)
-            return json1["novel"][list(json1["novel"].keys())[0]]
+            return next(iter(json1["novel"].values()))
+
+    class Image:
+
+        def __init__(self, type, id, novel=None):
+            self._imgType = type
+            self._imgId   = id
+            self._novelID = novel # needed for uploadedimage
+
+        def data(self):
+            if not self._imgType in ["pixivimage", "uploadedimage"]:
+                raise Exception(f"BackendPixiv.Image: unknown image type {self._imgType}")
+            jso = BackendPixiv.Novel(self._novelID)._getData() if self._imgType == "uploadedimage" else None
+            url = BackendPixiv.Novel._imageURL(jso, self._imgType, self._imgId)
+            return viewRawData(
+                mime    = mimetypes.guess_type(url)[0] or "application/octet-stream",
+                body    = BackendPixiv.Novel._image(self._imgType, url),
+                headers = [("Cache-Control", "max-age=31536000, immutable")],
+            )
 
 BACKEND_TABLE = {
     "pixiv": BackendPixiv,
@@ -493,71 +553,66 @@ class viewNovelData:
     date:  datetime.datetime
     pages: Optional[list[viewNovelDataPage]] = None # For toc page (mokuji)
 
+# static part of <head> (html below is written without indentation, as it is sent as is)
+VIEW_NOVEL_HEAD = """<meta http-equiv="content-type" content="text/html; charset=utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<!--<link rel="stylesheet" href="_style.css">-->
+<style>
+body { max-width: 700px; margin: 1em auto; padding: 0 .5em; }
+@media screen and (max-aspect-ratio: .75) and (max-width: 13cm) { /* Mobile */
+body { max-width: 100%; margin: 0.5em 0.5em }
+}
+#novel { line-height: 1.9; border-bottom: solid #888 1px; margin-bottom: 2em; padding-bottom: 3em; }
+#data { display: none }
+</style>"""
+
 def viewNovel(d:viewNovelData):
 
     # print(json.dumps(dataclasses.asdict(dataclasses.replace(d, body='')), default=str, ensure_ascii=False, indent=2))
 
-    o_css = """
-        body { max-width: 700px; margin: 1em auto; padding: 0 .5em; }
-        @media screen and (max-aspect-ratio: .75) and (max-width: 13cm) { /* Mobile */
-            body { max-width: 100%; margin: 0.5em 0.5em }
-        }
-        #novel { line-height: 1.9; border-bottom: solid #888 1px; margin-bottom: 2em; padding-bottom: 3em; }
-        #data { display: none }
-    """
-
-    o_tags = ",\n".join(f"<a href='{mkurl(d.site, 'search', q=x)}'>{x}</a>" for x in d.tags)
+    o_tags = ",\n".join(f"<a href='{mkurl(d.site, 'search', q=x)}'>{esc(x)}</a>" for x in d.tags)
 
-    o_rSign = re.sub("^ *", " ", d.rate) if d.rate else ""
+    o_rSign = " " + d.rate.lstrip(" ") if d.rate else ""
 
-    o_info = f"""
-        <p> タグ: {o_tags} </p>
-        <p>
-            <a href="{d.orig}">{d.site.capitalize()}で開く</a>
-            ID:{d.id}
-            U:<a href="{mkurl(d.site, 'user', id=d.user[0])}">{d.user[0]}</a>
-            B:{d.score}
-            D:{d.date.strftime("%Y-%m-%d")}
-        </p>
-    """
+    o_info = f"""<p> タグ: {o_tags} </p>
+<p>
+<a href="{d.orig}">{d.site.capitalize()}で開く</a>
+ID:{d.id}
+U:<a href="{mkurl(d.site, 'user', id=d.user[0])}">{d.user[0]}</a>
+B:{d.score}
+D:{d.date.strftime("%Y-%m-%d")}
+</p>"""
 
     nl = "\n"
-    o_toc = "" if not d.pages else f"""
-        <ul>
-            {nl.join(f'''
-                <li>
-                    <span style="display:none">{p.page}</span>
-                    <a href="{mkurl(d.site, 'novel', id=p.id, page=p.page)}">
-                        {escape(p.title)}
-                    </a>
-                    <br>
-                    <div>{p.desc}</div>
-                </li>
-            ''' for p in d.pages)}
-        </ul>
-    """
-
-    o_html = f"""
-        <!DOCTYPE html>
-        <html lang="ja">
-        <head>
-            <title>{o_rSign}{d.title} - {d.site}</title>
-            <meta http-equiv="content-type" content="text/html; charset=utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1">
-            <!--<link rel="stylesheet" href="_style.css">-->
-            <style>{o_css}</style>
-        </head>
-        <body>
-            <h1>{d.title}</h1>
-            <div id="novel">
-                {d.body}
-                {o_toc}
-            </div>
-            <div id="info"> <p> {d.desc} </p> {o_info} </div>
-        </body>
-        </html>
-    """
-    o_html = "\n".join(x.strip() for x in o_html.splitlines())
+    o_toc = "" if not d.pages else f"""<ul>
+{nl.join(f'''<li>
+<span style="display:none">{p.page}</span>
+<a href="{mkurl(d.site, 'novel', id=p.id, page=p.page)}">
+{esc(p.title)}
+</a>
+<br>
+<div>{p.desc}</div>
+</li>''' for p in d.pages)}
+</ul>"""
+
+    o_html = f"""<!DOCTYPE html>
+<html lang="ja">
+<head>
+<title>{o_rSign}{esc(d.title)} - {d.site}</title>
+{VIEW_NOVEL_HEAD}
+</head>
+<body>
+<h1>{esc(d.title)}</h1>
+<div id="novel">
+{d.body}
+{o_toc}
+</div>
+<div id="info"> <p> {d.desc} </p>
+{o_info}
+</div>
+</body>
+</html>
+"""
     # <div id="data" data-novels='{o_json}'></div>
 
     return o_html
@@ -594,16 +649,18 @@ class viewSearchData:
 
 def viewSearch(d:viewSearchData):
 
+    compact = d.mode == "compact"
+
     # create form from a specification and default values
     def makeForm(formSpec, values, action):
         elems1, elems2 = [], []
         for x in formSpec:
             if x["type"] == "text":
-                elem = f'<input type=text name="{x["name"]}" value="{values[x["name"]]}" placeholder="{x.get("args", {}).get("placeholder", 0)}">'
+                elem = f'<input type=text name="{x["name"]}" value="{esc(values[x["name"]])}" placeholder="{x.get("args", {}).get("placeholder", 0)}">'
             elif x["type"] == "number":
-                elem = f'<input type=number name="{x["name"]}" value="{values[x["name"]]}" size=3 min="{x.get("args", {}).get("min", 0)}">'
+                elem = f'<input type=number name="{x["name"]}" value="{esc(values[x["name"]])}" size=3 min="{x.get("args", {}).get("min", 0)}">'
             elif x["type"] == "hidden":
-                elem = f'<input type=hidden name="{x["name"]}" value="{values[x["name"]]}">'
+                elem = f'<input type=hidden name="{x["name"]}" value="{esc(values[x["name"]])}">'
             elif x["type"] == "select":
                 elem = f'<select name="{x["name"]}">\n'
                 for value, text in x["args"]:
@@ -642,11 +699,11 @@ def viewSearch(d:viewSearchData):
         values = { x["name"]: getattr(d, x["field"], x.get("default", "")) for x in d.form }
         hrefPrev   = mkurl(**{ **values, "page": max(1, d.page-d.npages) })
         hrefNext   = mkurl(**{ **values, "page": d.page+d.npages })
-        hrefToggle = mkurl(**{ **values, "mode": "detailed" if d.mode == "compact" else "compact" })
+        hrefToggle = mkurl(**{ **values, "mode": "detailed" if compact else "compact" })
         html = f"""
             <div id="nav" style="display: flex">
                 <span style="flex: 1">
-                    <a href="{hrefToggle}">{"詳細表示" if d.mode == "compact" else "コンパクト表示"}</a>
+                    <a href="{hrefToggle}">{"詳細表示" if compact else "コンパクト表示"}</a>
                 </span>
                 <span style="flex: 1"></span>
         """
@@ -673,17 +730,20 @@ def viewSearch(d:viewSearchData):
     """
 
     # novels
-    novels = "<table>" if d.mode == "compact" else "<ul>"
+    novels = ["<table>" if compact else "<ul>"]
     for x in d.items: # self._novels
         href = mkurl(d.site, "novel", id=x.id)
-        if d.mode == "compact":
-            novels += f"<tr><td><a href=\"{href}\">{x.id}</a></td><td>{re.sub('^ *', ' ', x.rate) if x.rate else ''}</td><td>{x.score}</td><td>{x.title}</td></tr>\n"
+        if compact:
+            novels.append(f"<tr><td><a href=\"{href}\">{x.id}</a></td><td>{' ' + x.rate.lstrip(' ') if x.rate else ''}</td><td>{x.score}</td><td>{esc(x.title)}</td></tr>\n")
         else:
-            desc = "<br>".join(replaceLinks(x.desc).split("<br />")[0:5])
-            desc = addMissingCloseTags(desc, tags=["b", "s", "u", "strong"])
-            tags = ", ".join([f"<a href=\"/{d.site}/search?q={escape(y)}\">{y}</a>" for y in x.tags])
-            novels += f"<li>{x.title} ({x.length}字) <a href=\"{href}\">[{x.id}]</a><p>{desc}</p>{emoji['love']} {x.score}<br>{tags}</li><hr>\n"
-    novels += "</table>" if d.mode == "compact" else "</ul>"
+            desc = replaceLinks(x.desc) if "https://" in x.desc else x.desc # most descriptions have no links or tags
+            desc = "<br>".join(desc.split("<br />", 5)[:5])
+            if "<" in desc:
+                desc = addMissingCloseTags(desc, tags=("b", "s", "u", "strong"))
+            tags = ", ".join([f"<a href=\"{mkurl(d.site, 'search', q=y)}\">{esc(y)}</a>" for y in x.tags])
+            novels.append(f"<li>{esc(x.title)} ({x.length}字) <a href=\"{href}\">[{x.id}]</a><p>{desc}</p>{emoji['love']} {x.score}<br>{tags}</li><hr>\n")
+    novels.append("</table>" if compact else "</ul>")
+    novels = "".join(novels)
 
     # search bar
     o_searchBar = searchBar()
@@ -699,13 +759,13 @@ def viewSearch(d:viewSearchData):
         <!DOCTYPE html>
         <html lang="ja">
         <head>
-            <title>{o_title} - {d.site}</title>
+            <title>{esc(o_title)} - {d.site}</title>
             <meta http-equiv="content-type" content="text/html; charset=utf-8">
             <meta name="viewport" content="width=device-width, initial-scale=1">
             <style> {css} </style>
         </head>
         <body>
-            <h1>{o_title}</h1>
+            <h1>{esc(o_title)}</h1>
             {o_searchBar}
             {o_header}
             <hr>
@@ -718,6 +778,12 @@ def viewSearch(d:viewSearchData):
     o_html = "\n".join(x.strip() for x in o_html.splitlines())
     return o_html
 
+@dataclasses.dataclass
+class viewRawData: # not rendered by a view function, but sent as is
+    mime:    str
+    body:    bytes
+    headers: list = dataclasses.field(default_factory=lambda: [])
+
 VIEW_TABLE = {
     viewNovelData:  viewNovel,
     viewSearchData: viewSearch,
@@ -738,7 +804,7 @@ class Resources:
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
             'Accept-Language': 'ja,en-US;q=0.7,en;q=0.3',
-            'Accept-Encoding': 'gzip',
+            'Accept-Encoding': 'gzip, deflate', # no br (brotli is not in stdlib)
             'Connection': 'keep-alive',
             'Upgrade-Insecure-Requests': '1',
             'Sec-Fetch-Dest': 'document',
@@ -905,68 +971,170 @@ class CharaColor:
         },
     }
 
-    _db = {} # same as _db0, but with better saturation and lightness, and uses rgb() format. also last name and name with spaces stripped as keys
-    for series in _db0:
-        _db[series] = {}
-        for name in _db0[series]:
-            color1   = _db0[series][name]
-            match    = re.match(r"#(..)(..)(..)", re.sub(r"#(.)(.)(.)$", r"\1\1\2\2\3\3", color1))
-            assert match, f"Invalid color {color1} (expected: #rrggbb or #rgb)"
-            h,l,s    = colorsys.rgb_to_hls(*[int(x, 16) / 256 for x in match.groups()])
-            r,g,b    = colorsys.hls_to_rgb(*[h, _lightness, _saturation] if s > 0.01 else [h, l, s])
-            color2   = "rgb(%s)" % ",".join([str(int(x * 256)) for x in [r, g, b]])
-            lastname = re.search(r"\S*$", name).group(0)
-            nospname = re.sub(r"\s", "", name)
-            _db[series][lastname] = color2
-            _db[series][nospname] = color2
+    _db      = None # same as _db0, but with better saturation and lightness, and uses rgb() format. also last name and name with spaces stripped as keys
+    _dbCSS    = None # _dbCSS[series][name] = css line for the name
+    _dbSeries = None # _dbSeries[name] = list of series having the name in _db[series]
+
+    @classmethod
+    def _loadDB(cls):
+        # build _db etc. on first use (not needed at all with --nocolor)
+        if cls._dbSeries is not None:
+            return
+        db = {}
+        for series in cls._db0:
+            db[series] = {}
+            for name in cls._db0[series]:
+                color1   = cls._db0[series][name]
+                hex1     = color1[1:] if len(color1) == 7 else "".join(x * 2 for x in color1[1:]) # "#rgb" -> "rrggbb"
+                assert color1[0] == "#" and len(hex1) == 6, f"Invalid color {color1} (expected: #rrggbb or #rgb)"
+                r,g,b    = [x / 256 for x in bytes.fromhex(hex1)]
+                # Same as colorsys.rgb_to_hls then hls_to_rgb with _lightness and _saturation (if s > 0.01),
+                # using the fact that hue determines the relative position of each channel between min and max
+                maxc     = max(r, g, b)
+                minc     = min(r, g, b)
+                l        = (maxc + minc) / 2
+                s        = 0 if maxc == minc else (maxc - minc) / (maxc + minc if l <= 0.5 else 2 - maxc - minc)
+                if s > 0.01:
+                    L, S = cls._lightness, cls._saturation
+                    m2   = L * (1 + S) if L <= 0.5 else L + S - L * S
+                    m1   = 2 * L - m2
+                    k    = (m2 - m1) / (maxc - minc)
+                    r,g,b = m1 + k * (r - minc), m1 + k * (g - minc), m1 + k * (b - minc)
+                color2   = "rgb(%d,%d,%d)" % (r * 256, g * 256, b * 256)
+                lastname = re.search(r"\S*$", name).group(0)
+                nospname = re.sub(r"\s", "", name)
+                db[series][lastname] = color2
+                db[series][nospname] = color2
+        cls._db      = db
+        cls._dbCSS   = { series: { name: ".name_%s { color: %s; }" % (name, color) for name, color in colors.items() } for series, colors in db.items() }
+        dbSeries = {}
+        for series, names in db.items():
+            for name in names:
+                dbSeries.setdefault(name, []).append(series)
+        cls._dbSeries = dbSeries # set last, as it marks db is loaded
+
+    # regex to find character names starting a serifu: 1 = line beginning, 2 = name, 3 = open paren etc.
+    # written to run in linear time (no backtracking into runs of spaces):
+    # 1 does not match across newlines and is atomic (lookahead + backreference, as possessive "*+" needs python 3.11),
+    # and 2 never ends in the middle of spaces before 3
+    #                            (1          )  (2                      )(3                   )
+    _serifuRegex = re.compile(r"^(?=([^\S\n]*))\1(|.*?(?<![^\S\r\n]))([^\S\r\n]*[(（「『｢])", re.MULTILINE) # ) dummy parent to fix indent
 
     @classmethod
+    @functools.lru_cache(maxsize=16) # output depends only on html; the same novel is often viewed repeatedly
     def colorHTML(self, html):
         # color character names starting a serifu (e.g. 太郎 in "太郎「こんにちは」")
 
-        # regex: 1 = line beginning, 2 = name, 3 = open paren etc.
-        #         (1   )(2  )(3                   )
-        regex = r"(^\s*)(.*?)([^\S\r\n]*[(（「『｢])" # ) dummy parent to fix indent
+        self._loadDB()
 
         # Find what series is this html (different serieses may have same name charas with different colors)
         # list of characters found in html (with multiplicity, excluding bad patterns)
         def isCharaName(s): return len(s) > 0 and (not s.startswith("―"))
-        charaList = [x[1] for x in re.findall(regex, html, flags=re.MULTILINE) if isCharaName(x[1])]
-        # get series with most matching names in charaList
-        series = max(self._db.keys(), key = lambda series: len([s for s in charaList if s in self._db[series].keys()]))
+        matches = list(self._serifuRegex.finditer(html)) # html is scanned only once (reused when wrapping names below)
+        charaList = [m[2] for m in matches if isCharaName(m[2])]
+        if not charaList:
+            return html
+        # get series with most matching names in charaList (tally each name's series; ties go to the first series in _db)
+        charaCount = collections.Counter(charaList)
+        scores = collections.Counter()
+        for name, count in charaCount.items():
+            for s in self._dbSeries.get(name, ()):
+                scores[s] += count
+        series = max(self._db.keys(), key=lambda s: scores[s])
 
         # If at most 1/2 of charaList will get colored, it's likely that series is incorrect
         # We don't have a db for the correct series
-        if 0.5 * len(charaList) > len([s for s in charaList if s in self._db[series].keys()]):
+        if 0.5 * len(charaList) > scores[series]:
             return html
 
-        # Wrap with <span>
+        # Wrap with <span> (decor[name] is the decorated html for each name to be colored)
         def nosp(s): return s.replace(" ", "")
-        def decorHTML(name):
-            if not nosp(name) in self._db[series]: return name
-            return f"<span class='name name_{nosp(name)}'>{name}</span>"
+        decor = { name: f"<span class='name name_{nosp(name)}'>{name}</span>" for name in set(charaList) if nosp(name) in self._db[series] }
 
         # CSS
-        style = "<style>\n.name { font-weight: bold }\n" + "\n".join([".name_%s { color: %s; }" % (nosp(name), color) for (name, color) in self._db[series].items() if name in charaList]) + "\n</style>\n"
+        style = "<style>\n.name { font-weight: bold }\n" + "\n".join([css for (name, css) in self._dbCSS[series].items() if name in charaCount]) + "\n</style>\n"
 
-        # HTML (modified)
-        html = re.sub(regex, lambda m: m.group(1) + decorHTML(m.group(2)) + m.group(3), html, flags=re.MULTILINE)
+        # HTML (modified; copy text between names to be wrapped)
+        out, pos = [style], 0
+        for m in matches:
+            if m[2] in decor:
+                out += [html[pos:m.start(2)], decor[m[2]]]
+                pos = m.end(2)
+        out.append(html[pos:])
 
-        return style + html
+        return "".join(out)
 
 
 ### Misc mini functions
 
+URI_UNSAFE_REGEX = re.compile(r"""[^][!"#$&'()*+,/:;=?@A-Za-z0-9_.~-]+""") # chars not allowed in URI
+
 class HttpGet:
 
     def __init__(self):
         self.times = {}
-
-    def tryDecode(self, data):
-        for enc in ["utf-8", "shift-jis", "euc-jp", "cp932"]:
+        self.timesLock = threading.Lock() # httpGet is called from multiple threads
+        self.conns = {} # conns[(scheme, netloc)] = list of idle keep-alive connections
+        self.connsLock = threading.Lock()
+        self.maxIdleConns = 16 # per (scheme, netloc)
+        self.timeout = 30 # seconds
+
+    def getConnection(self, scheme, netloc, reuse=True):
+        with self.connsLock:
+            idle = self.conns.get((scheme, netloc))
+            if reuse and idle:
+                return idle.pop(), True
+        return (http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection)(netloc, timeout=self.timeout), False
+
+    def putConnection(self, scheme, netloc, conn):
+        with self.connsLock:
+            idle = self.conns.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxIdleConns:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers):
+        # GET url with pooled keep-alive connections (saves TCP and TLS handshakes), following redirects
+        # returns (status, response headers, body); raises urllib.error.HTTPError like urlopen
+        for _ in range(10):
+            parsed = urllib.parse.urlsplit(url)
+            target = (parsed.path or "/") + ("?" + parsed.query if parsed.query else "")
+            def fetch(conn): # send request and read the whole response; conn is closed on any error
+                try:
+                    conn.request("GET", target, headers=headers)
+                    res = conn.getresponse()
+                    return res, res.read()
+                except BaseException:
+                    conn.close()
+                    raise
+            conn, reused = self.getConnection(parsed.scheme, parsed.netloc)
+            try:
+                res, data = fetch(conn)
+            except (ConnectionError, http.client.BadStatusLine, ssl.SSLError):
+                # idle connection was closed by server; retry once with a new connection
+                if not reused:
+                    raise
+                conn, reused = self.getConnection(parsed.scheme, parsed.netloc, reuse=False)
+                res, data = fetch(conn)
+            if res.will_close:
+                conn.close()
+            else:
+                self.putConnection(parsed.scheme, parsed.netloc, conn)
+            if res.status in [301, 302, 303, 307, 308] and res.headers["Location"]:
+                url = urllib.parse.urljoin(url, res.headers["Location"])
+                continue
+            if not (200 <= res.status < 300):
+                raise urllib.error.HTTPError(url, res.status, res.reason, res.headers, io.BytesIO(data))
+            return res.status, res.headers, data
+        raise Exception(f"HttpGet: too many redirects: {url}")
+
+    def tryDecode(self, data, hint=None):
+        # hint: charset from Content-Type header, tried first (pixiv sends utf-8, so usually decoded once)
+        for enc in ([hint] if hint else []) + ["utf-8", "shift-jis", "euc-jp", "cp932"]:
             try:
                 return data.decode(enc)
-            except UnicodeDecodeError:
+            except (UnicodeDecodeError, LookupError):
                 pass
         assert False, "Could not decode data"
 
@@ -977,40 +1145,51 @@ class HttpGet:
         assert fmt in ["str", "json", "bytes"]
 
         # %-encode chars not allowed in URI, see https://en.wikipedia.org/wiki/Percent-encoding
-        regex = r"""[^][!"#$&'()*+,/:;=?@A-Za-z0-9_.~-]+"""
-        for m in re.findall(regex, url):
-            url = url.replace(m, urllib.parse.quote(m))
+        url = URI_UNSAFE_REGEX.sub(lambda m: urllib.parse.quote(m[0]), url)
 
         # Rate limiting per domain:port
         loc = urllib.parse.urlparse(url).netloc
-        y = max(self.times.setdefault(loc, 0), (x := time.time())) # send request at y
-        self.times[loc] = y + 0.5 + min(3, y - x) # exponential wait time, at most 3.5 between requests
+        # (self.times[loc] is the earliest monotonic time the next request to loc may be sent)
+        with self.timesLock:
+            now      = time.monotonic()
+            nextTime = self.times.get(loc, 0.0)
+            wait     = max(0.0, nextTime - now)
+            self.times[loc] = now + wait + 0.5 + min(3, wait) # exponential wait time, at most 3.5 between requests
         # Sleep if needed
-        if y - x > 0.1:
-            logging.info(f"HttpGet: requests to the same domain {loc} in a short period, sleeping for {y-x}")
-            time.sleep(y - x)
+        if wait > 0.1:
+            logging.info(f"HttpGet: requests to the same domain {loc} in a short period, sleeping for {wait}")
+            time.sleep(wait)
 
         # Merge headers
         if isinstance(headers, list):
-            headers = dict(sum((list(x.items()) for x in headers), []))
-
-        # Actually send request and catch error
-        req = urllib.request.Request(url, headers=headers)
-        try:
-            res = urllib.request.urlopen(req)
-        except (urllib.error.HTTPError, urllib.error.URLError, Exception) as e:
-            raise e
+            merged = {}
+            for x in headers:
+                merged.update(x)
+            headers = merged
+
+        # Actually send request
+        if urllib.request.getproxies().get(urllib.parse.urlsplit(url).scheme):
+            # proxies are supported only by urllib
+            res = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+            status, resHeaders, data = res.status, res.headers, res.read()
+        else:
+            status, resHeaders, data = self.request(url, headers)
 
-        if res.status != 200:
-            raise Exception(f"http non-200: {res.status}")
+        if status != 200:
+            raise Exception(f"http non-200: {status}")
 
         # Decompress, decode, and optionally parse json (and html?)
-        data = res.read()
-        if "gzip" == ("Content-Encoding" in res.headers and res.headers["Content-Encoding"]):
-            data = gzip.decompress(data) # may miss deflate and brotli
+        encoding = (resHeaders["Content-Encoding"] or "").strip().lower()
+        if encoding == "gzip":
+            data = gzip.decompress(data)
+        elif encoding == "deflate":
+            try:
+                data = zlib.decompress(data)
+            except zlib.error: # some servers send raw deflate without zlib header
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
         if fmt == "bytes":
             return data
-        data = self.tryDecode(data)
+        data = self.tryDecode(data, resHeaders.get_content_charset())
         if fmt == "json":
             return json.loads(data)
         elif fmt == "str":
@@ -1020,42 +1199,75 @@ class HttpGet:
 
 httpGet = HttpGet()
 
+MEMORY_CACHE      = collections.OrderedDict() # name => (time fetched, value), least recently used first
+MEMORY_CACHE_SIZE = 64
+MEMORY_CACHE_LOCK = threading.Lock()
+
+def withMemoryCache(name, getStamped, expiry=600):
+    # in-process cache, to skip reading and json decoding of cache files for frequently requested items
+    # expiry is in seconds
+    # getStamped returns (value, time.time() when value was fetched); the value is not kept if the time is None
+    with MEMORY_CACHE_LOCK:
+        item = MEMORY_CACHE.get(name)
+        if item and time.time() - item[0] <= expiry:
+            MEMORY_CACHE.move_to_end(name)
+            logging.debug("memory cache is used " + name)
+            return item[1]
+    value, fetched = getStamped()
+    if fetched is None:
+        return value
+    with MEMORY_CACHE_LOCK:
+        MEMORY_CACHE[name] = (fetched, value)
+        MEMORY_CACHE.move_to_end(name)
+        while len(MEMORY_CACHE) > MEMORY_CACHE_SIZE:
+            MEMORY_CACHE.popitem(last=False)
+    return value
+
+CACHE_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+CACHE_NAME_REGEX = re.compile(r"^[a-zA-Z0-9-._]*$")
+
 def withFileCache(name, getDefault, expiry=600):
     # note: when cache is expired and getDefault fails, returns old cache
     # expiry is in seconds
     # getDefault should return json-serializable data
+    # returns (value, time.time() when value was fetched)
+    # the time is the cache file's mtime for cache hits, and None for the old cache returned when updating failed
     cachedir = CONFIG["cachedir"]
     if not cachedir:
-        return getDefault()
-    if not re.match(r"^[a-zA-Z0-9-._]*$", name):
+        return getDefault(), time.time()
+    if not CACHE_NAME_REGEX.match(name):
         raise Exception("Invalid cache name", name)
-    if not os.path.isdir(cachedir):
-        os.makedirs(cachedir, exist_ok=True)
     file = cachedir + os.sep + name
     # TODO avoid json encoding/decoding for strings and bytes
     def updateCache():
+        fetched = time.time()
         value = getDefault()
-        with open(file, "w") as f:
-            json.dump(value, f, ensure_ascii=False, separators=(",", ":"))
-        return value
+        data = CACHE_JSON_ENCODER.encode(value).encode("utf-8")
+        if not os.path.isdir(cachedir): # checked only when writing; hits cost a single stat of the file
+            os.makedirs(cachedir, exist_ok=True)
+        with open(file, "wb") as f:
+            f.write(data)
+        return value, fetched
     def readCache():
-        with open(file, "r") as f:
-            return json.load(f)
+        with open(file, "rb") as f:
+            return json.loads(f.read())
     try:
-        if datetime.datetime.now().timestamp() - os.stat(file).st_mtime > expiry:
+        mtime = os.path.getmtime(file)
+        if time.time() - mtime > expiry:
             try:
-                value = updateCache()
+                value, fetched = updateCache()
                 logging.debug("cache updating " + name)
             except:
-                value = readCache()
+                value, fetched = readCache(), None
                 logging.debug("cache failed updating, using old " + name)
         else:
-            value = readCache()
+            value, fetched = readCache(), mtime
             logging.debug("cache is used " + name)
     except FileNotFoundError:
-        value = updateCache()
+        value, fetched = updateCache()
         logging.debug("cache new item " + name)
-    return value
+    return value, fetched
 
 class StringParser:
 
@@ -1080,17 +1292,20 @@ class StringParser:
                 return default
         return self.string[p1+nt1:p2]
 
+PIXIV_LINK_REGEX = re.compile(r"https://www\.pixiv\.net/(?:users/([0-9]*)|novel/show\.php\?id=([0-9]*))") # 1 = user id, 2 = novel id
+
 def replaceLinks(desc, addTag=False): # replace novel/xxxxx links and user/xxxxx links
-    f1 = lambda m: mkurl("user", id=m[1])
-    f2 = lambda m: mkurl("novel", id=m[1])
-    g1 = lambda m: f'<a href="{mkurl("user", id=m[1])}">user/{m[1]}</a>'
-    g2 = lambda m: f'<a href="{mkurl("novel", id=m[1])}">novel/{m[1]}</a>'
-    for (regex, rep) in [
-        (r"https://www.pixiv.net/users/([0-9]*)",              g1 if addTag else f1),
-        (r"https://www.pixiv.net/novel/show.php\?id=([0-9]*)", g2 if addTag else f2),
-    ]:
-        desc = re.sub(regex, rep, desc)
-    return desc
+    def rep(m):
+        kind, id = ("user", m[1]) if m[1] is not None else ("novel", m[2])
+        url = mkurl(kind, id=id)
+        return f'<a href="{url}">{kind}/{id}</a>' if addTag else url
+    return PIXIV_LINK_REGEX.sub(rep, desc)
+
+HTML_ESCAPE_TABLE = str.maketrans({ "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" })
+
+def esc(s):
+    "Escape html special chars (like html.escape, but in a single pass)"
+    return str(s).translate(HTML_ESCAPE_TABLE)
 
 def getRSign(spec):
     "Get canonical rating sign"
@@ -1101,34 +1316,51 @@ def getRSign(spec):
     }
     return mapping[spec]
 
+@functools.lru_cache(maxsize=4096)
 def percentEncode(word):
     return urllib.parse.quote_plus(word, encoding="utf-8")
 
+def parseQuery(query):
+    # Same as { k: v[0] for k, v in urllib.parse.parse_qs(query).items() }, but unquotes only when needed
+    def unquote(s): return urllib.parse.unquote_plus(s) if ("%" in s or "+" in s) else s
+    param = {}
+    for field in query.split("&"):
+        k, _, v = field.partition("=")
+        if v:
+            param.setdefault(unquote(k), unquote(v))
+    return param
+
 def mkurl(*args, **kwargs):
-    return ("/" if len(args) else "") + "/".join(percentEncode(str(v)) for v in args if v) + ("?" if kwargs else "") + "&".join(f"{k}={percentEncode(str(v))}" for k, v in kwargs.items() if v)
+    # kwargs order is kept, as it is the order of query parameters
+    # values are converted to str (None if falsy, i.e. omitted) before the cached part,
+    # so that the cache key is hashable and equal-but-different values (1 and True) do not share an entry
+    return _mkurl(tuple(str(v) if v else None for v in args), tuple((k, str(v) if v else None) for k, v in kwargs.items()))
 
-def addMissingCloseTags(html, tags=["b", "s", "u", "strong"]):
+@functools.lru_cache(maxsize=4096)
+def _mkurl(args, kwargs):
+    return ("/" if len(args) else "") + "/".join(percentEncode(v) for v in args if v is not None) + ("?" if kwargs else "") + "&".join(f"{k}={percentEncode(v)}" for k, v in kwargs if v is not None)
 
-    # "aaa<b"  ==>  "aaa"
-    m = re.search("<[^>]*$", html)
-    if m:
-        html = html[:m.start(0)]
+@functools.lru_cache(maxsize=16)
+def tagsRegex(tags:tuple[str]):
+    return re.compile(r"<\s*(/?)\s*(" + "|".join(tags) + r")\s*>")
 
-    # Count opened counts for each tag in `tags`
-    counts = {}
-    for m in re.finditer(r"<\s*(/?)\s*(" + "|".join(tags) + r")\s*>", html):
-        t = m.group(2)
-        if m.group(1) == "/":
-            counts[t] = (counts[t] - 1) if t in counts else -1
-        else:
-            counts[t] = (counts[t] + 1) if t in counts else 1
+def addMissingCloseTags(html, tags=("b", "s", "u", "strong")):
+
+    # "aaa<b"  ==>  "aaa" (cut at the first "<" after the last ">")
+    lt = html.find("<", html.rfind(">") + 1)
+    if lt >= 0:
+        html = html[:lt]
 
-    # For each tag, if opened count > closed count then add close tags
-    for t in counts:
-        if counts[t] > 0:
-            html += ("</" + t + ">") * counts[t]
+    # Track tags in `tags` that are still open (a close tag closes the latest open tag of the same name)
+    opened = []
+    for close, tag in tagsRegex(tuple(tags)).findall(html):
+        if not close:
+            opened.append(tag)
+        elif tag in opened:
+            del opened[len(opened) - 1 - opened[::-1].index(tag)]
 
-    return html
+    # Close them in reverse order of opening, so that they nest properly
+    return html + "".join("</" + t + ">" for t in reversed(opened))
 
 def readCookiestxtAsHTTPCookieHeader(cookiestxt, domain):
     # Read Netscape HTTP Cookie File and return string for urllib request header
@@ -1141,12 +1373,12 @@ def readCookiestxtAsHTTPCookieHeader(cookiestxt, domain):
 
             for line in f:
                 # Skip empty or comment lines
-                if re.match(r"^\s*$", line) or re.match(r"^# ", line):
+                if not line or line.isspace() or line.startswith("# "):
                     continue
-                fields = line[:-1].split('\t')
+                fields = line.rstrip("\r\n").split('\t')
                 # Each line must have 7 fields and has the specified
-                if len(fields) == 7 and (not domain or fields[0].find(domain) != -1):
-                    results += [ f"{fields[5]}={fields[6]}" ]
+                if len(fields) == 7 and (not domain or domain in fields[0]):
+                    results.append(f"{fields[5]}={fields[6]}")
 
             logging.info(f"Loaded {len(results)} cookies for {domain} from {cookiestxt}")
             return "; ".join(results) # something like "name=val; name=val"
@@ -1164,19 +1396,27 @@ def openInBrowser(url):
 def yesterday():
     return datetime.date.today() - datetime.timedelta(days = 1)
 
-def saveFile(name, text, maxLenBytes=os.pathconf('/', 'PC_NAME_MAX'), prefix="", suffix=""):
+try:
+    FS_NAME_MAX = os.pathconf('/', 'PC_NAME_MAX')
+except (AttributeError, OSError): # os.pathconf is not available on Windows
+    FS_NAME_MAX = 255
+
+FS_SAFE_TABLE = str.maketrans({ "\\": " ", "/": " ", "*": " ", "<": " ", ">": " ", "|": " ", '"': "”", ":": "：", "?": "？" })
+
+def saveFile(name, text, maxLenBytes=FS_NAME_MAX, prefix="", suffix=""):
     def fsSafeChars(s):
-        return re.sub(r'[\\/*<>|]', " ", s).replace('"', "”").replace(":", "：").replace("?", "？")
+        return s.translate(FS_SAFE_TABLE)
     def trunc(s, lenBytes, suffix=""):
         # Tuncate s so that (s+suffix).encode("utf-8") has at most lenBytes bytes, and return s+suffix
         # Will not chop in the middle of byte-sequence representing single unicode character
-        lenS       = len(s)
-        # lenSU      = len(s.encode("utf-8"))
-        lenSuffixU = len(suffix.encode("utf-8"))
-        i          = lenS
-        while len(s[:i].encode("utf-8")) + lenSuffixU > lenBytes:
-            i -= 1
-        return s[:i] + suffix
+        sU     = s.encode("utf-8")
+        budget = max(0, lenBytes - len(suffix.encode("utf-8")))
+        if len(sU) <= budget:
+            return s + suffix
+        cut = budget
+        while cut > 0 and (sU[cut] & 0xC0) == 0x80: # utf-8 continuation byte
+            cut -= 1
+        return sU[:cut].decode("utf-8") + suffix
     outfile = trunc(fsSafeChars(prefix + name), maxLenBytes, fsSafeChars(suffix))
     savedir = CONFIG["savedir"]
     if not os.path.isdir(savedir): os.makedirs(savedir, exist_ok=True)